@@ -31,9 +31,14 @@ __keywords__ = [
 __url__ = 'https://github.com/rrwen/google_streetview'
 __download_url__ = 'https://github.com/rrwen/google_streetview/archive/master.zip'
 __install_requires__ = [
+  'httpx[http2]',
   'kwconfig',
-  'requests'
+  'orjson',
+  'requests',
+  'tqdm'
 ]
+__extras_require__ = {'uring': ['liburing>=2026.3.30']}
+__python_requires__ = '>=3.8'
 __packages__ = ['google_streetview']
 __package_data__ = {'google_streetview': ['config.json']}
 __entry_points__ = {'console_scripts': ['google_streetview=google_streetview.cli:run']}
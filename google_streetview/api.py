@@ -1,16 +1,62 @@
 # -*- coding: utf-8 -*-
 
 from google_streetview import helpers
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
 from pathlib import Path
-from os import path, makedirs
+from os import path, makedirs, SEEK_END
 from pprint import pprint
 try:
   from urllib.parse import urlencode
 except ImportError:
   from urllib import urlencode
+import asyncio
 import re
-import json
+import httpx
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from tqdm.contrib.concurrent import thread_map
+from urllib3.util.retry import Retry
+
+_GSV_RE = re.compile(r'gsv_(\d+)\.jpg$')
+_RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# (session) Pooled session shared by threaded downloads
+_session = requests.Session()
+_session.mount('https://', HTTPAdapter(
+  pool_connections=16,
+  pool_maxsize=64,
+  max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=_RETRY_STATUS)))
+
+def _last_byte(f, end):
+  """Find the position and value of the last non-whitespace byte before ``end`` in a binary file."""
+  while end > 0:
+    start = max(0, end - 64)
+    f.seek(start)
+    chunk = f.read(end - start).rstrip()
+    if chunk:
+      return start + len(chunk) - 1, chunk[-1:]
+    end = start
+  return -1, b''
+
+async def _get_with_retry(client, url, retries=3, backoff_factor=0.2):
+  """GET a URL with an async client, retrying with exponential backoff on the same statuses as ``_session``."""
+  for attempt in range(retries + 1):
+    r = await client.get(url)
+    if r.status_code not in _RETRY_STATUS or attempt == retries:
+      return r
+    await asyncio.sleep(backoff_factor * 2 ** attempt)
+
+def _run(coro):
+  """Run a coroutine to completion, on a worker thread if an event loop is already running (e.g. Jupyter)."""
+  try:
+    asyncio.get_running_loop()
+  except RuntimeError:
+    return asyncio.run(coro)
+  with ThreadPoolExecutor(max_workers=1) as ex:
+    return ex.submit(asyncio.run, coro).result()
 
 class results:
   """Google Street View Image API results.
@@ -25,6 +71,8 @@ class results:
       The site for the URL request (example: https://maps.googleapis.com/maps/api/streetview).
     site_metadata(str):
       The site for the URL `metadata <https://developers.google.com/maps/documentation/streetview/metadata>`_ request (example: https://maps.googleapis.com/maps/api/streetview/metadata).
+    check_via_image_error (bool):
+      Add ``return_error_code=true`` to the image links so that :meth:`api.results.download_links` skips unavailable images on a 404 instead of requesting metadata.
   
   Attributes:
     params (listof dict):
@@ -32,10 +80,13 @@ class results:
     links (listof str):
       List of str containing street view URL requests.
     metadata (listof dict):
-      Objects returned from `street view metadata request <https://developers.google.com/maps/documentation/streetview/metadata>`_.
+      Objects returned from `street view metadata request <https://developers.google.com/maps/documentation/streetview/metadata>`_, requested on first access.
     metadata_links (listof str):
       List of str containing street view URL metadata requests.
   
+  Notes:
+    * Metadata responses are kept in a class-level LRU cache of up to ``results._meta_cache_size`` queries, so repeated parameters are only requested once
+  
   Examples: 
     ::
     
@@ -66,30 +117,158 @@ class results:
       # Save metadata
       results.save_metadata('metadata.json')
   """
+  _meta_cache = OrderedDict()
+  _meta_cache_size = 4096
+  
   def __init__(
     self,
     params,
     site_api='https://maps.googleapis.com/maps/api/streetview',
-    site_metadata='https://maps.googleapis.com/maps/api/streetview/metadata'):
+    site_metadata='https://maps.googleapis.com/maps/api/streetview/metadata',
+    check_via_image_error=False):
+    self.check_via_image_error = check_via_image_error
     
     # (params) Set default params
     defaults = {
       'size': '640x640'
     }
-    for i in range(len(params)):
-        params[i] = dict(defaults, **params[i])
-    self.params = params
     
-    # (image) Create image api links from parameters
-    self.links = [site_api + '?' + urlencode(p) for p in params]
+    # (links) Create image and metadata api links from parameters in one pass
+    error_code = '&return_error_code=true' if check_via_image_error else ''
+    self.params, self.links, self.metadata_links = [], [], []
+    for p in params:
+      merged = {**defaults, **p}
+      qs = urlencode(merged, doseq=True)
+      self.params.append(merged)
+      self.links.append(f'{site_api}?{qs}{error_code}')
+      self.metadata_links.append(f'{site_metadata}?{qs}')
     
-    # (metadata) Create metadata api links and data from parameters
-    self.metadata_links = [site_metadata + '?' + urlencode(p) for p in params]
-    self.metadata = [requests.get(url, stream=True).json() for url in self.metadata_links]
-      
-  def download_links(self, dir_path, metadata_file='metadata.json', metadata_status='status', status_ok='OK', mode="w"):
+    # (metadata) Cache keys for the metadata of each parameter query
+    self._metadata_keys = [(site_metadata, urlencode(sorted(p.items()), doseq=True)) for p in self.params]
+  
+  @cached_property
+  def metadata(self):
+    """Request the street view metadata for each parameter query once on first access."""
+    return self._cached_metadata(self._metadata_keys, self.metadata_links)
+  
+  def _cached_metadata(self, keys, urls):
+    """Get street view metadata from the cache, requesting only the missing queries.
+    
+    Args:
+      keys (listof tuple):
+        Cache keys of the parameter queries.
+      urls (listof str):
+        List of str containing street view URL metadata requests for each key.
+    
+    Returns:
+      A ``listof dict`` of metadata responses in the same order as ``keys``.
+    """
+    cache = results._meta_cache
+    
+    # (misses) Request each distinct uncached query once
+    misses = {}
+    for key, url in zip(keys, urls):
+      if key not in cache and key not in misses:
+        misses[key] = url
+    fetched = {}
+    if misses:
+      fetched = dict(zip(misses, _run(self._fetch_metadata_async(list(misses.values())))))
+    
+    # (cache) Store only responses that will not change for the same query
+    for key, m in fetched.items():
+      if m.get('status') in ('OK', 'ZERO_RESULTS', 'NOT_FOUND'):
+        cache[key] = m
+    
+    # (metadata) Reassemble in input order with a copy per query for file references
+    out = []
+    for key in keys:
+      if key in fetched:
+        out.append(dict(fetched[key]))
+      else:
+        cache.move_to_end(key)
+        out.append(dict(cache[key]))
+    while len(cache) > results._meta_cache_size:
+      cache.popitem(last=False)
+    return out
+  
+  async def _fetch_metadata_async(self, urls):
+    """Concurrently request street view metadata multiplexed over one HTTP/2 connection.
+    
+    HTTPS servers that negotiate HTTP/2 serve every request over a single connection,
+    otherwise the requests are spread over a small pool of HTTP/1.1 connections.
+    Responses with a 429 or 5xx status are retried with backoff, and a response
+    that still fails is returned as an ``UNKNOWN_ERROR`` status so that the rest of
+    the batch is kept.
+    
+    Args:
+      urls (listof str):
+        List of str containing street view URL metadata requests.
+    
+    Returns:
+      A ``listof dict`` of metadata responses in the same order as ``urls``.
+    """
+    async def _one(url, client):
+      r = await _get_with_retry(client, url)
+      if r.status_code != 200:
+        return {'status': 'UNKNOWN_ERROR', 'error_message': f'HTTP {r.status_code}'}
+      return orjson.loads(r.content)
+    
+    limits = httpx.Limits(max_keepalive_connections=16, max_connections=16)
+    async with httpx.AsyncClient(http2=True, limits=limits, timeout=30) as client:
+      return await asyncio.gather(*[_one(u, client) for u in urls])
+  
+  async def _download_async(self, downloads, batch_size=256):
+    """Concurrently download street view images over a single HTTP/2 client.
+    
+    Downloaded images are collected and written in batches of ``batch_size``
+    with :func:`helpers.write_files`. Failed connections and responses with a
+    429 or 5xx status are retried with backoff, as in the threaded downloads.
+    Images with a non-200 response are marked as not downloaded, while connection
+    and write errors are raised once the finished images have been written.
+    
+    Args:
+      downloads (listof tuple):
+        List of (url, file_path) tuples of images to download.
+      batch_size (int):
+        Number of downloaded images to collect before writing them to disk.
+    
+    Returns:
+      A ``listof bool`` indicating which images were downloaded, in the same order as ``downloads``.
+    """
+    sem = asyncio.Semaphore(16)
+    loop = asyncio.get_running_loop()
+    batch = []
+    
+    async def _dl(url, file_path):
+      async with sem:
+        r = await _get_with_retry(client, url)
+      if r.status_code != 200: # unavailable (404 with return_error_code) or failed
+        return False
+      batch.append((file_path, r.content))
+      if len(batch) >= batch_size:
+        files, batch[:] = batch[:], []
+        await loop.run_in_executor(None, helpers.write_files, files)
+      return True
+    
+    limits = httpx.Limits(max_connections=32, max_keepalive_connections=32)
+    transport = httpx.AsyncHTTPTransport(http2=True, limits=limits, retries=3)
+    try:
+      async with httpx.AsyncClient(transport=transport, timeout=30) as client:
+        saved = await asyncio.gather(*[_dl(url, file_path) for url, file_path in downloads], return_exceptions=True)
+    finally:
+      helpers.write_files(batch) # always write finished downloads
+    errors = [s for s in saved if isinstance(s, BaseException)]
+    if errors:
+      raise errors[0]
+    return saved
+  
+  def download_links(self, dir_path, metadata_file='metadata.json', metadata_status='status', status_ok='OK', mode="w", use_threads=False):
     """Download Google Street View images from parameter queries if they are available.
     
+    If :class:`api.results` was created with ``check_via_image_error``, every link is requested
+    and unavailable images are skipped on a 404 without requesting metadata. The metadata file
+    is then only saved if :class:`api.results`.metadata was already requested.
+    
     Args:
       dir_path (str):
         Path of directory to save downloads of images from :class:`api.results`.links
@@ -99,24 +278,35 @@ class results:
         Key name of the status value from :class:`api.results`.metadata response from the metadata API request.
       status_ok (str):
         Value from the metadata API response status indicating that an image is available.
+      mode (str):
+        Mode passed to :meth:`api.results.save_metadata` when saving ``metadata_file``.
+      use_threads (bool):
+        Download with a thread pool of :func:`helpers.download` calls and a progress bar instead of asyncio.
     """
     dir_path = Path(dir_path)
-    dir_path.makedirs(exist_ok=True)
-
-    max_index = max([0]+[re.findall(r"gsv\_(\d*).jpg",f.name)[0] for f in dir_path.iterdir()])
+    dir_path.mkdir(parents=True, exist_ok=True)
     
-    if max_index:
-      max_index = max_index + 1
-
+    # (index) Continue numbering after previously downloaded images
+    max_index = max((int(m.group(1)) for f in dir_path.glob('gsv_*.jpg') for m in (_GSV_RE.match(f.name),) if m), default=-1) + 1
     
-    # (download) Download images if status from metadata is ok
-    for i, url in enumerate(self.links):
-      if self.metadata[i][metadata_status] == status_ok:
-        file_path = Path(dir_path) / f'gsv_{max_index + i}.jpg'
-        self.metadata[i]['_file'] = file_path.name # add file reference
-        helpers.download(url, file_path)
+    # (download) Download images if status from metadata is ok or all images if checked via image errors
+    prefix = f'{dir_path}/gsv_'
+    if self.check_via_image_error:
+      available = range(len(self.links))
+    else:
+      available = [i for i, m in enumerate(self.metadata) if m.get(metadata_status) == status_ok]
+    downloads = [(self.links[i], Path(f'{prefix}{max_index + i}.jpg')) for i in available]
+    if use_threads:
+      saved = thread_map(lambda d: helpers.download(*d, session=_session), downloads, max_workers=16, chunksize=4)
+    else:
+      saved = _run(self._download_async(downloads))
     
     # (metadata) Save metadata with file reference
+    if self.check_via_image_error and 'metadata' not in self.__dict__:
+      return
+    for i, (_, file_path), ok in zip(available, downloads, saved):
+      if ok:
+        self.metadata[i]['_file'] = file_path.name # add file reference
     metadata_path = dir_path / metadata_file
     self.save_metadata(metadata_path, mode)
 
@@ -138,17 +328,19 @@ class results:
     for i, kv in enumerate(items[:n]):
       
       # (print_header) Print result header
-      header = '\n[' + str(i) + '] ' + kv[kheader]
+      header = f'\n[{i}] {kv[kheader]}'
       print(header)
       print('=' * len(header))
         
       # (print_metadata) Print result metadata
       for ki in k:
-        if ki in kv:
-          if ki == 'location':
-            print(ki + ': \n  lat: ' + str(kv[ki]['lat']) + '\n  lng: ' + str(kv[ki]['lng']))
-          else:
-            print(ki + ': ' + str(kv[ki]))
+        val = kv.get(ki)
+        if val is None:
+          continue
+        if ki == 'location':
+          print(f"{ki}: \n  lat: {val['lat']}\n  lng: {val['lng']}")
+        else:
+          print(f'{ki}: {val}')
       
   def save_links(self, file_path):
     """Saves a text file of the search result links.
@@ -163,26 +355,66 @@ class results:
       file_path (str):
         Path to the text file to save links to.
     """
-    data = '\n'.join(self.links)
-    with open(file_path, 'w+') as out_file:
-      out_file.write(data)
+    with open(file_path, 'w', buffering=1 << 20) as out_file:
+      out_file.writelines(link + '\n' for link in self.links)
   
   def save_metadata(self, file_path, mode="w"):
     """Save Google Street View metadata from parameter queries.
     
+    In append mode the records are added in place to the JSON array of an existing file
+    by overwriting its closing bracket, so only the new records are written on every call.
+    
     Args:
       file_path (str):
         Path of the file with extension to save the :class:`api.results`.metadata
+      mode (str):
+        ``'w'`` to overwrite the file or ``'a'`` to append to the JSON array in the file.
     """
     file_path = Path(file_path)
-    metadata = self.metadata
-    if mode == "a" and file_path.exists():
-      with file_path.open('r') as out_file:
-        current_metadata = json.load(out_file)
-        metadata = current_metadata.append(metadata)
-
-    with file_path.open('w+') as out_file:
-      json.dump(metadata, out_file)
-
-
-      
+    if mode == "a" and file_path.exists() and file_path.stat().st_size > 0:
+      if not self.metadata:
+        return
+      with file_path.open('r+b') as out_file:
+        
+        # (tail) Find the closing bracket of the existing array
+        pos, last = _last_byte(out_file, out_file.seek(0, SEEK_END))
+        if last != b']':
+          raise ValueError(f'{file_path} does not contain a JSON array to append metadata to')
+        empty = _last_byte(out_file, pos)[1] == b'['
+        
+        # (append) Replace the closing bracket with the new records
+        out_file.seek(pos)
+        out_file.write((b'' if empty else b',') + orjson.dumps(self.metadata)[1:] + b'\n')
+        out_file.truncate()
+      return
+    with file_path.open('wb') as out_file:
+      out_file.write(orjson.dumps(self.metadata, option=orjson.OPT_APPEND_NEWLINE))
+  
+  def save_metadata_jsonl(self, file_path):
+    """Append Google Street View metadata to a newline-delimited JSON file.
+    
+    Each record in :class:`api.results`.metadata is written as a single line, so
+    repeated calls only write the new records.
+    
+    Args:
+      file_path (str):
+        Path of the JSON lines file to append the :class:`api.results`.metadata to
+    """
+    with open(file_path, 'ab') as out_file:
+      out_file.write(b''.join(orjson.dumps(m) + b'\n' for m in self.metadata))
+  
+  @classmethod
+  def load_metadata_jsonl(cls, file_path):
+    """Read Google Street View metadata from a newline-delimited JSON file.
+    
+    Args:
+      file_path (str):
+        Path of the JSON lines file written by :meth:`api.results.save_metadata_jsonl`
+    
+    Returns:
+      A generator of ``dict`` metadata records in file order.
+    """
+    with open(file_path, 'rb') as in_file:
+      for line in in_file:
+        if line.strip():
+          yield orjson.loads(line)
@@ -2,8 +2,14 @@
 
 from itertools import product
 
+import os
+import platform
 import requests
 import shutil
+try:
+  import liburing
+except ImportError:
+  liburing = None
 
 def api_list(apiargs):
   """Google Street View Image API results.
@@ -71,9 +77,91 @@ def api_list(apiargs):
     out.append(api_copy)
   return(out)
 
-def download(url, file_path):
-  r = requests.get(url, stream=True)
-  if r.status_code == 200: # if request is successful
+def download(url, file_path, session=None):
+  """Download a street view image to a file if the request is successful.
+  
+  Args:
+    url (str):
+      Street view URL request for the image.
+    file_path (str):
+      Path of the file to save the image to.
+    session (:class:`requests.Session`):
+      Optional session to reuse pooled connections across downloads.
+  
+  Returns:
+    ``True`` if the image was saved, otherwise ``False``.
+  """
+  with (session or requests).get(url, stream=True, timeout=30) as r:
+    if r.status_code != 200: # unavailable (404 with return_error_code) or failed
+      r.content # drain the error body so the pooled connection is reused
+      return False
     with open(file_path, 'wb') as f:
       r.raw.decode_content = True
       shutil.copyfileobj(r.raw, f)
+  return True
+
+def _uring_supported():
+  """Check if ``liburing`` (2026.3.30+ API) is installed and the Linux kernel is at least 5.10."""
+  if liburing is None or not hasattr(liburing, 'Ring') or platform.system() != 'Linux':
+    return False
+  try:
+    version = tuple(int(v) for v in platform.release().split('-')[0].split('.')[:2])
+  except ValueError:
+    return False
+  return version >= (5, 10)
+
+def _write_files_uring(files):
+  """Write a batch of files by submitting all writes through a single io_uring queue."""
+  fds = [os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644) for file_path, _ in files]
+  try:
+    ring = liburing.Ring()
+    cqe = liburing.Cqe()
+    liburing.io_uring_queue_init(len(files), ring, 0)
+    try:
+      
+      # (uring) Queue one write per file, submit once, then reap all completions
+      for i, (fd, (_, data)) in enumerate(zip(fds, files)):
+        sqe = liburing.io_uring_get_sqe(ring)
+        liburing.io_uring_prep_write(sqe, fd, data, 0)
+        liburing.io_uring_sqe_set_data64(sqe, i)
+      liburing.io_uring_submit(ring)
+      for _ in files:
+        liburing.io_uring_wait_cqe(ring, cqe)
+        entry = cqe[0]
+        res, i = entry.res, entry.user_data
+        liburing.io_uring_cqe_seen(ring, entry)
+        liburing.trap_error(res)
+        written = res
+        
+        # (short) Finish short writes so no truncated image is left behind
+        data = memoryview(files[i][1])
+        while written < len(data):
+          written += os.pwrite(fds[i], data[written:], written)
+    finally:
+      liburing.io_uring_queue_exit(ring)
+  finally:
+    for fd in fds:
+      os.close(fd)
+
+def write_files(files):
+  """Write a batch of downloaded files to disk.
+  
+  On Linux 5.10+ with `liburing <https://pypi.org/project/liburing/>`_ installed (``pip install google_streetview[uring]``),
+  the writes are submitted together through a single io_uring queue. Otherwise, or if io_uring
+  is unavailable at runtime, each file is written with ``open().write()``.
+  
+  Args:
+    files (listof tuple):
+      List of (file_path, bytes) tuples to write.
+  """
+  if not files:
+    return
+  if _uring_supported():
+    try:
+      _write_files_uring(files)
+      return
+    except (AttributeError, TypeError, OSError): # incompatible liburing or io_uring blocked
+      pass
+  for file_path, data in files:
+    with open(file_path, 'wb') as f:
+      f.write(data)
@@ -1,14 +1,39 @@
 # -*- coding: utf-8 -*-
 
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from os import listdir, remove
-from os.path import isdir, isfile
+from os.path import getmtime, isdir, isfile, join
 from pkg_resources import resource_filename, Requirement
 from unittest import TestCase
+from unittest.mock import patch
 from shutil import rmtree
 from tempfile import TemporaryFile, TemporaryDirectory
+from threading import Thread
 
+import asyncio
 import google_streetview.api
+import httpx
 import json
+import requests
+
+def fake_fetch(calls, status='OK'):
+  async def _fetch(self, urls):
+    calls.append(list(urls))
+    return [{'status': status, 'url': u} for u in urls]
+  return _fetch
+
+class metadataHandler(BaseHTTPRequestHandler):
+  
+  def do_GET(self):
+    body = b'<html>error</html>' if self.path == '/error' else b'{"status": "OK"}'
+    self.send_response(500 if self.path == '/error' else 200)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+  
+  def log_message(self, *args):
+    pass
 
 class apiTest(TestCase):
 
@@ -23,6 +48,7 @@ class apiTest(TestCase):
       'pitch': '-0.76',
       'key': defaults['key']
     }]
+    self.params = params
     self.results = google_streetview.api.results(params)
     tempfile = TemporaryFile()
     self.tempfile = str(tempfile.name)
@@ -40,11 +66,92 @@ class apiTest(TestCase):
     rmtree(self.tempdir)
     self.assertTrue(nfiles > 0)
   
+  def test_download_links_threads(self):
+    self.results.download_links(self.tempdir, use_threads=True)
+    files = sorted(listdir(self.tempdir))
+    with open(join(self.tempdir, 'metadata.json'), 'r') as f:
+      metadata = json.load(f)
+    self.assertTrue(files == ['gsv_0.jpg', 'metadata.json'])
+    self.assertTrue(metadata[0]['_file'] == 'gsv_0.jpg')
+  
+  def test_download_links_connection_error(self):
+    results = google_streetview.api.results(self.params, site_api='http://127.0.0.1:9/sv', check_via_image_error=True)
+    with self.assertRaises(httpx.ConnectError):
+      results.download_links(self.tempdir)
+    with self.assertRaises(requests.ConnectionError):
+      results.download_links(self.tempdir, use_threads=True)
+  
+  def test_download_links_continue_index(self):
+    self.results.download_links(self.tempdir)
+    first = join(self.tempdir, 'gsv_0.jpg')
+    mtime = getmtime(first)
+    self.results.download_links(self.tempdir)
+    files = sorted(listdir(self.tempdir))
+    self.assertTrue(files == ['gsv_0.jpg', 'gsv_1.jpg', 'metadata.json'])
+    self.assertTrue(getmtime(first) == mtime)
+  
+  def test_download_links_check_via_image_error(self):
+    results = google_streetview.api.results(self.params, check_via_image_error=True)
+    results.download_links(self.tempdir)
+    files = listdir(self.tempdir)
+    rmtree(self.tempdir)
+    self.assertTrue(files == ['gsv_0.jpg'])
+  
   def test_metadata_status_ok(self):
     status = self.results.metadata[0]['status']
     expected = 'OK'
     self.assertTrue(status == expected)
   
+  def test_metadata_in_event_loop(self):
+    async def _metadata():
+      return google_streetview.api.results(self.params).metadata
+    metadata = asyncio.run(_metadata())
+    self.assertTrue(metadata[0]['status'] == 'OK')
+  
+  def test_metadata_cache(self):
+    calls = []
+    params = [{'location': 'a'}, {'location': 'b'}, {'location': 'a'}]
+    with patch.object(google_streetview.api.results, '_meta_cache', OrderedDict()), \
+         patch.object(google_streetview.api.results, '_fetch_metadata_async', fake_fetch(calls)):
+      results = google_streetview.api.results(params)
+      metadata = results.metadata
+      links = results.metadata_links
+      self.assertTrue(calls == [[links[0], links[1]]])
+      self.assertTrue([m['url'] for m in metadata] == [links[0], links[1], links[0]])
+      metadata[0]['_file'] = 'gsv_0.jpg'
+      self.assertTrue('_file' not in metadata[2])
+      cached = google_streetview.api.results(params).metadata
+      self.assertTrue(len(calls) == 1)
+      self.assertTrue(all('_file' not in m for m in cached))
+  
+  def test_metadata_cache_eviction(self):
+    calls = []
+    with patch.object(google_streetview.api.results, '_meta_cache', OrderedDict()), \
+         patch.object(google_streetview.api.results, '_meta_cache_size', 2), \
+         patch.object(google_streetview.api.results, '_fetch_metadata_async', fake_fetch(calls)):
+      google_streetview.api.results([{'location': 'a'}, {'location': 'b'}, {'location': 'c'}]).metadata
+      self.assertTrue(len(google_streetview.api.results._meta_cache) == 2)
+      google_streetview.api.results([{'location': 'a'}]).metadata
+      self.assertTrue(len(calls) == 2)
+  
+  def test_metadata_cache_denied(self):
+    calls = []
+    with patch.object(google_streetview.api.results, '_meta_cache', OrderedDict()), \
+         patch.object(google_streetview.api.results, '_fetch_metadata_async', fake_fetch(calls, 'REQUEST_DENIED')):
+      google_streetview.api.results([{'location': 'a'}]).metadata
+      google_streetview.api.results([{'location': 'a'}]).metadata
+      self.assertTrue(len(calls) == 2)
+  
+  def test_metadata_http_error(self):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), metadataHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    site = 'http://127.0.0.1:' + str(server.server_address[1])
+    results = google_streetview.api.results([{'location': 'a'}])
+    metadata = google_streetview.api._run(results._fetch_metadata_async([site + '/error', site + '/ok']))
+    server.shutdown()
+    server.server_close()
+    self.assertTrue([m['status'] for m in metadata] == ['UNKNOWN_ERROR', 'OK'])
+  
   def test_save_links(self):
     results = self.results
     results.save_links(self.tempfile)
@@ -59,6 +166,30 @@ class apiTest(TestCase):
       metadata = json.load(f)
     self.assertTrue(metadata == results.metadata)
   
+  def test_save_metadata_append(self):
+    results = self.results
+    results.save_metadata(self.tempfile, mode='a')
+    results.save_metadata(self.tempfile, mode='a')
+    with open(self.tempfile, 'r') as f:
+      metadata = json.load(f)
+    self.assertTrue(metadata == results.metadata * 2)
+  
+  def test_save_metadata_append_whitespace(self):
+    results = self.results
+    with open(self.tempfile, 'w') as f:
+      f.write('[]' + ' ' * 100 + '\n' * 100)
+    results.save_metadata(self.tempfile, mode='a')
+    with open(self.tempfile, 'r') as f:
+      metadata = json.load(f)
+    self.assertTrue(metadata == results.metadata)
+  
+  def test_save_metadata_jsonl(self):
+    results = self.results
+    results.save_metadata_jsonl(self.tempfile)
+    results.save_metadata_jsonl(self.tempfile)
+    metadata = list(google_streetview.api.results.load_metadata_jsonl(self.tempfile))
+    self.assertTrue(metadata == results.metadata * 2)
+  
   def tearDown(self):
     if isfile(self.tempfile):
       remove(self.tempfile)
@@ -1,7 +1,29 @@
 # -*- coding: utf-8 -*-
 
 from google_streetview import helpers
-from unittest import TestCase
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import join
+from tempfile import TemporaryDirectory
+from threading import Thread
+from types import SimpleNamespace
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
+
+import requests
+
+class notFoundHandler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  clients = set()
+  
+  def do_GET(self):
+    notFoundHandler.clients.add(self.client_address)
+    self.send_response(404)
+    self.send_header('Content-Length', '9')
+    self.end_headers()
+    self.wfile.write(b'not found')
+  
+  def log_message(self, *args):
+    pass
 
 class cliTest(TestCase):
 
@@ -24,4 +46,39 @@ class cliTest(TestCase):
     }
     api_list = helpers.api_list(apiargs)
     self.assertTrue(144 == len(api_list))
-    
\ No newline at end of file
+  
+  def test_write_files(self):
+    with TemporaryDirectory() as tempdir:
+      files = [(join(tempdir, 'gsv_' + str(i) + '.jpg'), bytes([i]) * 10) for i in range(3)]
+      helpers.write_files(files)
+      for file_path, data in files:
+        with open(file_path, 'rb') as f:
+          self.assertTrue(f.read() == data)
+  
+  @skipUnless(helpers._uring_supported(), 'requires liburing on Linux 5.10+')
+  def test_write_files_uring(self):
+    with TemporaryDirectory() as tempdir:
+      files = [(join(tempdir, 'gsv_' + str(i) + '.jpg'), bytes([i]) * (i + 1) * 100000) for i in range(8)]
+      helpers._write_files_uring(files)
+      for file_path, data in files:
+        with open(file_path, 'rb') as f:
+          self.assertTrue(f.read() == data)
+  
+  def test_write_files_incompatible_uring(self):
+    with TemporaryDirectory() as tempdir, patch.object(helpers, 'liburing', SimpleNamespace(Ring=object)):
+      files = [(join(tempdir, 'gsv_0.jpg'), b'jpg')]
+      helpers.write_files(files)
+      with open(files[0][0], 'rb') as f:
+        self.assertTrue(f.read() == b'jpg')
+  
+  def test_download_not_found_reuses_connection(self):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), notFoundHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    session = requests.Session()
+    with TemporaryDirectory() as tempdir:
+      url = 'http://127.0.0.1:' + str(server.server_address[1]) + '/'
+      saved = [helpers.download(url + str(i), join(tempdir, 'gsv_0.jpg'), session=session) for i in range(5)]
+    server.shutdown()
+    server.server_close()
+    self.assertTrue(saved == [False] * 5)
+    self.assertTrue(len(notFoundHandler.clients) == 1)
@@ -23,5 +23,7 @@ setup(
   entry_points=package.__entry_points__,
   packages=package.__packages__,
   package_data=package.__package_data__,
-  install_requires=package.__install_requires__
+  install_requires=package.__install_requires__,
+  extras_require=package.__extras_require__,
+  python_requires=package.__python_requires__
 )